@@ -0,0 +1,358 @@
+# cython: language_level=3
+"""
+Compiled versions of ttftree's hot classes.
+
+ttftree uses this module when it's been built and its own pure-Python classes
+when it hasn't (or when the TTFTREE_NO_EXTENSION environment variable is set).
+Node and Digit replace ttftree's classes of the same names outright. DeepCore
+and the measure cores are used as the first base class of ttftree's Deep and
+of its item count, sum and min/max measures, so that the compiled methods take
+precedence while everything else (the rest of Deep's methods, docstrings,
+isinstance checks against Tree and Measure) still comes from ttftree. The
+classes here must behave identically to the pure-Python ones; see those for
+documentation.
+
+Nodes, Digits and Deeps are created on almost every operation on a tree, so
+most of the time spent by a deque-style workload goes into constructing them
+and combining their values' annotations. Both are done here without going
+through the interpreter. Annotations are computed in exactly the order the
+pure-Python classes compute them in (a left fold over each Node's or Digit's
+values), since measures aren't necessarily exactly associative (sums of
+floats, for example) and the two builds must produce equal annotations. An
+existing annotation is only reused where it's the prefix of that same fold:
+a Digit with a value added on the right, or a Digit made from a Node popped
+off of a spine.
+"""
+
+# Objects from ttftree that the classes here need; set by register() when
+# ttftree is imported.
+cdef object Single = None
+cdef object IDENTITY = None
+
+
+def register(single, identity):
+    """
+    Called by ttftree to hand over its Single class and IDENTITY object, which
+    this module can't import itself without a circular import.
+    """
+    global Single, IDENTITY
+    Single = single
+    IDENTITY = identity
+
+
+# _convert and _operator are equivalent to measure.convert(value) and
+# measure.operator(a, b), but call the compiled measures below directly
+# instead of looking up and calling a bound method. Being cpdef methods, those
+# still honor overrides in Python subclasses.
+
+cdef inline object _convert(object measure, object value):
+    if isinstance(measure, NodeMeasureCore):
+        return (<NodeMeasureCore>measure).convert(value)
+    elif isinstance(measure, MeasureItemCountCore):
+        return (<MeasureItemCountCore>measure).convert(value)
+    elif isinstance(measure, MeasureSumCore):
+        return (<MeasureSumCore>measure).convert(value)
+    elif isinstance(measure, MeasureMinMaxCore):
+        return (<MeasureMinMaxCore>measure).convert(value)
+    else:
+        return measure.convert(value)
+
+
+cdef inline object _operator(object measure, object a, object b):
+    if isinstance(measure, NodeMeasureCore):
+        return (<NodeMeasureCore>measure).operator(a, b)
+    elif isinstance(measure, MeasureItemCountCore):
+        return (<MeasureItemCountCore>measure).operator(a, b)
+    elif isinstance(measure, MeasureSumCore):
+        return (<MeasureSumCore>measure).operator(a, b)
+    elif isinstance(measure, MeasureMinMaxCore):
+        return (<MeasureMinMaxCore>measure).operator(a, b)
+    else:
+        return measure.operator(a, b)
+
+
+cdef object _fold(object measure, tuple values):
+    """
+    Equivalent to reduce(measure.operator, map(measure.convert, values)).
+    """
+    cdef Py_ssize_t i
+    result = _convert(measure, values[0])
+    for i in range(1, len(values)):
+        result = _operator(measure, result, _convert(measure, values[i]))
+    return result
+
+
+cdef class Node:
+    cdef readonly tuple _values
+    cdef readonly object measure
+    cdef readonly object annotation
+
+    def __init__(self, measure, *values):
+        cdef Py_ssize_t count = len(values)
+        if count != 2 and count != 3:
+            raise Exception("Nodes must have 2 or 3 children")
+        self._values = values
+        self.measure = measure
+        self.annotation = _fold(measure, values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Node(self.measure, *self._values[index])
+        else:
+            return self._values[index]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __reversed__(self):
+        return reversed(self._values)
+
+    def __add__(Node self, Node other):
+        return Node(self.measure, *self._values + other._values)
+
+    def __repr__(self):
+        return "<Node: %s>" % ", ".join([repr(v) for v in self._values])
+
+
+cdef Digit _make_digit(object measure, tuple values, object annotation):
+    """
+    Creates a Digit whose annotation is already known.
+    """
+    cdef Digit digit = Digit.__new__(Digit)
+    digit._values = values
+    digit.measure = measure
+    digit.annotation = annotation
+    return digit
+
+
+cdef Digit _fold_digit(object measure, tuple values):
+    return _make_digit(measure, values, _fold(measure, values))
+
+
+cdef class Digit:
+    cdef readonly tuple _values
+    cdef readonly object measure
+    cdef readonly object annotation
+
+    def __init__(self, measure, *values):
+        cdef Py_ssize_t count = len(values)
+        if count < 1 or count > 4:
+            raise Exception("Digits must have 1, 2, 3, or 4 children; the "
+                            "children given were %r" % list(values))
+        self._values = values
+        self.measure = measure
+        self.annotation = _fold(measure, values)
+
+    def partition_digit(self, initial_annotation, predicate):
+        cdef Py_ssize_t split_point = 0
+        cdef Py_ssize_t count = len(self._values)
+        convert = self.measure.convert
+        operator = self.measure.operator
+        while split_point < count:
+            current_annotation = operator(initial_annotation, convert(self._values[split_point]))
+            if predicate(current_annotation):
+                break
+            else:
+                split_point += 1
+                initial_annotation = current_annotation
+        return self._values[:split_point], self._values[split_point:]
+
+    def rpartition_digit(self, initial_annotation, predicate):
+        cdef Py_ssize_t split_point = len(self._values)
+        convert = self.measure.convert
+        operator = self.measure.operator
+        while split_point > 0:
+            current_annotation = operator(convert(self._values[split_point - 1]), initial_annotation)
+            if predicate(current_annotation):
+                break
+            else:
+                split_point -= 1
+                initial_annotation = current_annotation
+        return self._values[:split_point], self._values[split_point:]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Digit(self.measure, *self._values[index])
+        else:
+            return self._values[index]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __reversed__(self):
+        return reversed(self._values)
+
+    def __add__(Digit self, Digit other):
+        cdef tuple values = self._values + other._values
+        if len(values) > 4:
+            raise Exception("Digits must have 1, 2, 3, or 4 children; the "
+                            "children given were %r" % list(values))
+        # Fold over every value rather than combining the two annotations,
+        # which would associate differently from the pure-Python Digit.
+        return _fold_digit(self.measure, values)
+
+    def __repr__(self):
+        return "<Digit: %s>" % ", ".join([repr(v) for v in self._values])
+
+
+cdef Digit _digit_of_node(object measure, object node):
+    """
+    Creates a Digit containing the specified Node's values. The Node was built
+    with the same measure, and its annotation is the same left fold over the
+    same values, so it's reused as the Digit's annotation.
+    """
+    if type(node) is Node:
+        return _make_digit(measure, (<Node>node)._values, (<Node>node).annotation)
+    return _fold_digit(measure, tuple(node))
+
+
+cdef class DeepCore:
+    """
+    The compiled part of ttftree.Deep: its fields and its deque operations.
+    """
+    cdef public object measure
+    cdef public object annotation
+    cdef public object left
+    cdef public object spine
+    cdef public object right
+
+    def __init__(self, measure, left, spine, right):
+        self.measure = measure
+        self.annotation = _operator(measure, _operator(measure, left.annotation, spine.annotation), right.annotation)
+        self.left = left
+        self.spine = spine
+        self.right = right
+
+    cdef DeepCore _new(self, object left, object spine, object right):
+        """
+        Creates another instance of this Deep's class (i.e. ttftree.Deep)
+        with the same measure, without going through __init__.
+        """
+        cdef DeepCore deep = DeepCore.__new__(type(self))
+        measure = self.measure
+        deep.measure = measure
+        deep.annotation = _operator(measure, _operator(measure, left.annotation, spine.annotation), right.annotation)
+        deep.left = left
+        deep.spine = spine
+        deep.right = right
+        return deep
+
+    def get_first(self):
+        return (<Digit?>self.left)._values[0]
+
+    def get_last(self):
+        return (<Digit?>self.right)._values[-1]
+
+    def without_first(self):
+        cdef Digit left = <Digit?>self.left
+        cdef Digit right = <Digit?>self.right
+        measure = self.measure
+        if len(left._values) > 1:
+            return self._new(_fold_digit(measure, left._values[1:]), self.spine, right)
+        elif not self.spine.is_empty:
+            return self._new(_digit_of_node(measure, self.spine.get_first()), self.spine.without_first(), right)
+        elif len(right._values) == 1:
+            return Single(measure, right._values[0])
+        else:
+            return self._new(_fold_digit(measure, right._values[:1]), self.spine, _fold_digit(measure, right._values[1:]))
+
+    def without_last(self):
+        cdef Digit left = <Digit?>self.left
+        cdef Digit right = <Digit?>self.right
+        measure = self.measure
+        if len(right._values) > 1:
+            return self._new(left, self.spine, _fold_digit(measure, right._values[:-1]))
+        elif not self.spine.is_empty:
+            return self._new(left, self.spine.without_last(), _digit_of_node(measure, self.spine.get_last()))
+        elif len(left._values) == 1:
+            return Single(measure, left._values[0])
+        else:
+            return self._new(_fold_digit(measure, left._values[:-1]), self.spine, _fold_digit(measure, left._values[-1:]))
+
+    def add_first(self, new_item):
+        cdef Digit left = <Digit?>self.left
+        cdef tuple values = left._values
+        measure = self.measure
+        if len(values) < 4:
+            # new_item comes first in the fold, so the Digit's annotation
+            # can't be built on the old one.
+            return self._new(_fold_digit(measure, (new_item,) + values), self.spine, self.right)
+        else:
+            node = Node(measure, values[1], values[2], values[3])
+            return self._new(_fold_digit(measure, (new_item, values[0])), self.spine.add_first(node), self.right)
+
+    def add_last(self, new_item):
+        cdef Digit right = <Digit?>self.right
+        cdef tuple values = right._values
+        measure = self.measure
+        if len(values) < 4:
+            # The old Digit's annotation is the fold over all but the last of
+            # the new Digit's values, so this is the same fold as Digit's.
+            annotation = _operator(measure, right.annotation, _convert(measure, new_item))
+            return self._new(self.left, self.spine, _make_digit(measure, values + (new_item,), annotation))
+        else:
+            node = Node(measure, values[0], values[1], values[2])
+            return self._new(self.left, self.spine.add_last(node), _fold_digit(measure, (values[3], new_item)))
+
+
+cdef class NodeMeasureCore:
+    """
+    The compiled part of ttftree._NodeMeasure.
+    """
+    cdef readonly object wrapped
+
+    def __cinit__(self, measure, *args, **kwargs):
+        self.wrapped = measure
+
+    cpdef convert(self, node):
+        if type(node) is Node:
+            return (<Node>node).annotation
+        return node.annotation
+
+    cpdef operator(self, a, b):
+        return _operator(self.wrapped, a, b)
+
+
+cdef class MeasureItemCountCore:
+    """
+    The compiled part of ttftree.MeasureItemCount.
+    """
+    cpdef convert(self, value):
+        return 1
+
+    cpdef operator(self, a, b):
+        return a + b
+
+
+cdef class MeasureSumCore:
+    """
+    The compiled part of ttftree.MeasureSum.
+    """
+    cpdef convert(self, value):
+        return value
+
+    cpdef operator(self, a, b):
+        return a + b
+
+
+cdef class MeasureMinMaxCore:
+    """
+    The compiled part of ttftree.MeasureMinMax.
+    """
+    cpdef convert(self, value):
+        return value, value
+
+    cpdef operator(self, a, b):
+        if a is IDENTITY:
+            return b
+        elif b is IDENTITY:
+            return a
+        a_min, a_max = a
+        b_min, b_max = b
+        return min(a_min, b_min), max(a_max, b_max)
@@ -1,4 +1,14 @@
-from setuptools import setup
+from setuptools import setup, Extension
+
+# The _ttftree extension module is an optional accelerator; ttftree works
+# without it, so only build it if Cython is available and don't fail the
+# install if it can't be compiled.
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize([Extension("_ttftree", ["_ttftree.pyx"], optional=True)])
 
 setup(
     name="ttftree",
@@ -6,5 +16,7 @@ setup(
     description="A 2-3 finger tree library for Python",
     author="Alexander Boyd",
     author_email="alex@opengroove.org",
-    py_modules=["ttftree"]
+    py_modules=["ttftree"],
+    python_requires=">=3.8",
+    ext_modules=ext_modules
 )
@@ -0,0 +1,268 @@
+"""
+Randomized differential stress test for ttftree.
+
+Runs a long sequence of random operations against a tree annotated with each
+of ttftree's measures and, in lockstep, against a plain Python list. After
+every operation the tree's annotation is compared with the one recomputed from
+the list, and every so often the tree's values and structure are checked as
+well (with Tree.check_invariants). Time spent in the tree operations themselves
+is reported as a throughput figure for each measure so that optimizations to
+the hot paths can be checked for both correctness and speed in one go:
+
+    python stress.py --operations 100000 --seed 1234
+
+Any failure is reported with the seed and the operation number at which it
+occurred, so it can be reproduced by running again with the same seed.
+"""
+
+import argparse
+import random
+import sys
+import time
+from functools import reduce
+
+import ttftree
+
+
+def measures():
+    """
+    Returns a list of (name, measure) tuples of the measures to test. Each is
+    combined with MEASURE_ITEM_COUNT so that trees can be partitioned by
+    position regardless of what the measure itself computes. MEASURE_ITEM_COUNT
+    is also tested on its own, since only trees annotated with nothing but an
+    item count can be indexed by position (see op_set).
+    """
+    tested = [
+        ("MeasureItemCount", ttftree.MEASURE_ITEM_COUNT),
+        ("MeasureSum", ttftree.MeasureSum()),
+        ("MeasureLastItem", ttftree.MeasureLastItem()),
+        ("MeasureMinMax", ttftree.MeasureMinMax()),
+        ("MeasureContentHash", ttftree.MEASURE_CONTENT_HASH),
+        ("TranslateMeasure", ttftree.TranslateMeasure(lambda v: -v, ttftree.MeasureMinMax())),
+        ("CustomMeasure", ttftree.CustomMeasure(lambda v: (v,), lambda a, b: a + b, ())),
+    ]
+    return [("MEASURE_ITEM_COUNT", ttftree.MEASURE_ITEM_COUNT)] + [
+        (name, ttftree.CompoundMeasure(ttftree.MEASURE_ITEM_COUNT, measure)) for name, measure in tested]
+
+
+def expected_annotation(measure, values):
+    return reduce(measure.operator, map(measure.convert, values), measure.identity)
+
+
+def random_values(rng, max_size):
+    return [rng.randrange(1000) for _ in range(rng.randrange(max_size + 1))]
+
+
+def count_of(annotation):
+    """
+    Returns the item count from a tree annotation produced by one of the
+    measures returned from measures().
+    """
+    return annotation if isinstance(annotation, int) else annotation[0]
+
+
+def split_by_count(tree, k):
+    return tree.partition(lambda a: count_of(a) > k)
+
+
+def index_or_predicate(rng, tree, model, k):
+    """
+    Returns something to pass to Tree.set or Tree.update to pick out the kth
+    value of the tree: either k itself, or the equivalent negative index,
+    when the tree is annotated with an item count, or a predicate otherwise.
+    """
+    if isinstance(tree.annotation, int):
+        return rng.choice([k, k - len(model)])
+    return lambda a: count_of(a) > k
+
+
+# Each operation takes (rng, tree, model, measure) and returns a tuple
+# (run, new_model), where run is a function performing the operation on the
+# tree and new_model is the list the resulting tree should be equal to. Only
+# run is timed, so building the model doesn't count against throughput.
+# measure is the measure being tested, which is the tree's own measure unless
+# the tree is a reversed view.
+
+def op_add_first(rng, tree, model, measure):
+    value = rng.randrange(1000)
+    return (lambda: tree.add_first(value)), [value] + model
+
+
+def op_add_last(rng, tree, model, measure):
+    value = rng.randrange(1000)
+    return (lambda: tree.add_last(value)), model + [value]
+
+
+def op_without_first(rng, tree, model, measure):
+    if not model:
+        return (lambda: tree), model
+    return (lambda: tree.without_first()), model[1:]
+
+
+def op_without_last(rng, tree, model, measure):
+    if not model:
+        return (lambda: tree), model
+    return (lambda: tree.without_last()), model[:-1]
+
+
+def op_partition_and_rejoin(rng, tree, model, measure):
+    k = rng.randrange(len(model) + 2)
+    def run():
+        left, right = split_by_count(tree, k)
+        return left.append(right)
+    return run, model
+
+
+def op_rpartition_and_rejoin(rng, tree, model, measure):
+    k = rng.randrange(len(model) + 2)
+    def run():
+        left, right = tree.rpartition(lambda a: count_of(a) > k)
+        return left.append(right)
+    return run, model
+
+
+def op_delete_range(rng, tree, model, measure):
+    m = rng.randrange(len(model) + 1)
+    n = rng.randrange(m, len(model) + 1)
+    def run():
+        middle, right = split_by_count(tree, n)
+        left, middle = split_by_count(middle, m)
+        return left.append(right)
+    return run, model[:m] + model[n:]
+
+
+def op_insert(rng, tree, model, measure):
+    k = rng.randrange(len(model) + 1)
+    value = rng.randrange(1000)
+    def run():
+        left, right = split_by_count(tree, k)
+        return left.add_last(value).append(right)
+    return run, model[:k] + [value] + model[k:]
+
+
+def op_set(rng, tree, model, measure):
+    if not model:
+        return (lambda: tree), model
+    k = rng.randrange(len(model))
+    value = rng.randrange(1000)
+    new_model = list(model)
+    new_model[k] = value
+    key = index_or_predicate(rng, tree, model, k)
+    return (lambda: tree.set(key, value)), new_model
+
+
+def op_update(rng, tree, model, measure):
+    if not model:
+        return (lambda: tree), model
+    k = rng.randrange(len(model))
+    new_model = list(model)
+    new_model[k] += 1
+    key = index_or_predicate(rng, tree, model, k)
+    return (lambda: tree.update(key, lambda v: v + 1)), new_model
+
+
+def op_append_tree(rng, tree, model, measure):
+    values = random_values(rng, 40)
+    other = ttftree.to_tree(measure, values)
+    # Reversed views can't be joined with other trees without copying them,
+    # which has to be asked for explicitly.
+    if rng.randrange(2):
+        return (lambda: tree.materialize().append(other)), model + values
+    else:
+        return (lambda: tree.materialize().prepend(other)), values + model
+
+
+def op_reverse(rng, tree, model, measure):
+    return (lambda: tree.reversed()), model[::-1]
+
+
+def op_rotate(rng, tree, model, measure):
+    if not model:
+        return (lambda: tree), model
+    k = rng.randrange(len(model))
+    return (lambda: tree.rotate_with(lambda a: count_of(a) > k)), model[k:] + model[:k]
+
+
+OPERATIONS = [
+    (op_add_first, 6),
+    (op_add_last, 6),
+    (op_without_first, 4),
+    (op_without_last, 4),
+    (op_partition_and_rejoin, 2),
+    (op_rpartition_and_rejoin, 2),
+    (op_delete_range, 1),
+    (op_insert, 2),
+    (op_set, 3),
+    (op_update, 1),
+    (op_append_tree, 1),
+    (op_reverse, 1),
+    (op_rotate, 1),
+]
+
+
+class StressFailure(Exception):
+    pass
+
+
+def check(tree, model, check_values):
+    annotation = expected_annotation(tree.measure, model)
+    if tree.annotation != annotation:
+        raise StressFailure("annotation is %r, expected %r" % (tree.annotation, annotation))
+    if check_values:
+        values = list(ttftree.value_iterator(tree))
+        if values != model:
+            raise StressFailure("values are %r, expected %r" % (values, model))
+        tree.check_invariants()
+        if tree != ttftree.to_tree(tree.measure, model):
+            raise StressFailure("tree doesn't compare equal to a copy of itself")
+        if hash(tree) != hash(ttftree.to_tree(ttftree.MEASURE_ITEM_COUNT, model)):
+            raise StressFailure("tree's hash doesn't match a copy's")
+
+
+def run(name, measure, operations, seed, max_size, check_every):
+    rng = random.Random(seed)
+    functions = [function for function, weight in OPERATIONS for _ in range(weight)]
+    tree = ttftree.Empty(measure)
+    model = []
+    elapsed = 0.0
+    for i in range(operations):
+        function = rng.choice(functions)
+        # Keep the tree from growing without bound by only shrinking it once
+        # it reaches the maximum size.
+        if len(model) >= max_size:
+            function = rng.choice([op_without_first, op_without_last, op_delete_range])
+        operation, new_model = function(rng, tree, model, measure)
+        start = time.perf_counter()
+        new_tree = operation()
+        elapsed += time.perf_counter() - start
+        try:
+            check(new_tree, new_model, i % check_every == 0 or i == operations - 1)
+        except Exception as e:
+            raise StressFailure("%s: operation %d (%s) with seed %d failed: %s" % (name, i, function.__name__, seed, e))
+        tree, model = new_tree, new_model
+    return elapsed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--operations", type=int, default=20000, help="operations to run per measure")
+    parser.add_argument("--seed", type=int, default=None, help="random seed (default: random)")
+    parser.add_argument("--max-size", type=int, default=2000, help="largest size to let trees grow to")
+    parser.add_argument("--check-every", type=int, default=100, help="check full contents every this many operations")
+    options = parser.parse_args(args)
+    seed = options.seed if options.seed is not None else random.randrange(1 << 32)
+    print("Seed %d, %s Node and Digit" % (seed, ttftree.Node.__module__))
+    failed = False
+    for name, measure in measures():
+        try:
+            elapsed = run(name, measure, options.operations, seed, options.max_size, options.check_every)
+        except StressFailure as e:
+            print("FAIL %s" % e)
+            failed = True
+        else:
+            print("ok   %-20s %8d ops/s" % (name, options.operations / max(elapsed, 1e-9)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+import importlib.util
+import os
+import random
+import threading
+
+import pytest
+
+import stress
+import ttftree
+
+
+def _load_pure_ttftree():
+    """
+    Loads a second copy of ttftree with its compiled accelerator disabled, so
+    that the pure-Python classes can be tested alongside the compiled ones.
+    """
+    spec = importlib.util.spec_from_file_location("ttftree_pure", ttftree.__file__)
+    module = importlib.util.module_from_spec(spec)
+    old = os.environ.get("TTFTREE_NO_EXTENSION")
+    os.environ["TTFTREE_NO_EXTENSION"] = "1"
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        if old is None:
+            del os.environ["TTFTREE_NO_EXTENSION"]
+        else:
+            os.environ["TTFTREE_NO_EXTENSION"] = old
+    return module
+
+
+@pytest.fixture(scope="module", params=["python", "compiled"])
+def implementation(request):
+    """
+    Each of ttftree's implementations: the pure-Python one and the one using
+    the compiled accelerator (skipped when it hasn't been built).
+    """
+    if request.param == "python":
+        return _load_pure_ttftree()
+    if ttftree._ttftree is None:
+        pytest.skip("the compiled accelerator hasn't been built")
+    return ttftree
+
+
+def values(tree):
+    return list(ttftree.value_iterator(tree))
+
+
+class SlowReleaseLock(object):
+    """
+    A lock whose first release() blocks until the test allows it to proceed,
+    so that a test can act while a TreeRef is known to be holding its lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.holding = threading.Event()
+        self.proceed = threading.Event()
+
+    def acquire(self, blocking=True):
+        return self._lock.acquire(blocking)
+
+    def release(self):
+        if not self.proceed.is_set():
+            self.holding.set()
+            self.proceed.wait()
+        self._lock.release()
+
+
+@pytest.mark.parametrize("write", [
+    lambda ref: ref.set(ref.get().add_last("write")),
+    lambda ref: ref.compare_and_set(ref.get(), ref.get().add_last("write")),
+    lambda ref: ref.swap(lambda tree: tree.add_last("write")),
+    lambda ref: ref.flush(),
+], ids=["set", "compare_and_set", "swap", "flush"])
+def test_tree_ref_publishes_items_queued_while_lock_held(write):
+    ref = ttftree.TreeRef(ttftree.Empty(ttftree.MEASURE_ITEM_COUNT), batch=True)
+    ref._lock = lock = SlowReleaseLock()
+    writer = threading.Thread(target=write, args=(ref,))
+    writer.start()
+    assert lock.holding.wait(5)
+    # The writer holds the lock, so this only queues the item.
+    ref.add_last("queued")
+    lock.proceed.set()
+    writer.join(5)
+    assert not writer.is_alive()
+    # No flush(): the writer must have published the item on its way out.
+    assert values(ref.get())[-1] == "queued"
+    assert not ref._pending
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_tree_ref_concurrent_add_last(batch):
+    ref = ttftree.TreeRef(ttftree.Empty(ttftree.MEASURE_ITEM_COUNT), batch=batch)
+    def produce(n):
+        for i in range(500):
+            ref.add_last((n, i))
+            if i % 50 == 0:
+                ref.swap(lambda tree: tree)
+    threads = [threading.Thread(target=produce, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = values(ref.get())
+    assert ref.get().annotation == 4000
+    for n in range(8):
+        assert [i for m, i in result if m == n] == list(range(500))
+
+
+def test_stats_visits_shared_subtrees_once():
+    tree = ttftree.to_tree(ttftree.MEASURE_ITEM_COUNT, range(10))
+    for _ in range(20):
+        tree = tree.append(tree)
+    entries = list(ttftree._walk_structure(tree))
+    assert len(entries) == len(set(id(item) for kind, level, item in entries))
+    assert len(entries) < 1000
+    stats = tree.stats(tree)
+    assert stats.exclusive_bytes == 0
+    assert stats.shared_bytes == stats.total_bytes
+
+
+def test_stats_shared_with_other_version():
+    tree = ttftree.to_tree(ttftree.MEASURE_ITEM_COUNT, range(10000))
+    updated = tree.set(5000, "x")
+    stats = updated.stats(tree)
+    assert 0 < stats.exclusive_bytes < stats.shared_bytes
+    assert stats.total_bytes == stats.exclusive_bytes + stats.shared_bytes
+    assert [level.digit_count for level in stats.levels[:-1]] == [2] * (stats.depth - 1)
+
+
+def test_reversed_view_concatenation():
+    measure = ttftree.CompoundMeasure(ttftree.MEASURE_ITEM_COUNT, ttftree.MeasureLastItem())
+    tree = ttftree.to_tree(measure, range(10))
+    other = ttftree.to_tree(measure, range(10, 20))
+    view = tree.reversed()
+    assert values(view + other.reversed()) == list(range(9, -1, -1)) + list(range(19, 9, -1))
+    with pytest.raises(ttftree.MixedOrientation):
+        view + other
+    with pytest.raises(ttftree.MixedOrientation):
+        other + view
+    joined = view.materialize() + other
+    assert values(joined) == list(range(9, -1, -1)) + list(range(10, 20))
+    assert joined.annotation == (20, 19)
+    # Views of fewer than two values join with anything.
+    single = ttftree.to_tree(measure, ["x"]).reversed()
+    assert values(single + other) == ["x"] + list(range(10, 20))
+    assert values(other + single) == list(range(10, 20)) + ["x"]
+
+
+def test_reversed_view_uses_mirrored_measure():
+    tree = ttftree.to_tree(ttftree.MeasureLastItem(), [1, 2, 3])
+    view = tree.reversed()
+    assert values(view) == [3, 2, 1]
+    assert view.annotation == 3
+    assert view.materialize().annotation == 1
+
+
+def test_implementation_is_the_one_requested(implementation):
+    compiled = implementation._ttftree is not None
+    assert (implementation.Node.__module__ == "_ttftree") == compiled
+    tree = implementation.to_tree(implementation.MEASURE_ITEM_COUNT, range(100))
+    assert isinstance(tree, implementation.Deep)
+    assert isinstance(tree, implementation.Tree)
+    assert isinstance(implementation.MEASURE_ITEM_COUNT, implementation.Measure)
+
+
+@pytest.mark.parametrize("make_measure", [
+    lambda t: t.MEASURE_ITEM_COUNT,
+    lambda t: t.MeasureSum(),
+    lambda t: t.MeasureMinMax(),
+    lambda t: t.CompoundMeasure(t.MEASURE_ITEM_COUNT, t.MeasureLastItem()),
+], ids=["count", "sum", "minmax", "compound"])
+def test_digit_and_node(implementation, make_measure):
+    measure = make_measure(implementation)
+    def folded(values):
+        return stress.expected_annotation(measure, values)
+    for count in range(1, 5):
+        values = list(range(10, 10 + count))
+        digit = implementation.Digit(measure, *values)
+        assert list(digit) == values
+        assert list(reversed(digit)) == values[::-1]
+        assert len(digit) == count
+        assert digit[0] == values[0] and digit[-1] == values[-1]
+        assert digit.annotation == folded(values)
+        if count > 1:
+            assert list(digit[1:]) == values[1:]
+            assert digit[1:].annotation == folded(values[1:])
+        for other_count in range(1, 5 - count):
+            other_values = list(range(20, 20 + other_count))
+            joined = digit + implementation.Digit(measure, *other_values)
+            assert list(joined) == values + other_values
+            assert joined.annotation == folded(values + other_values)
+    for count in (2, 3):
+        values = list(range(count))
+        node = implementation.Node(measure, *values)
+        assert list(node) == values
+        assert len(node) == count
+        assert node.annotation == folded(values)
+    with pytest.raises(Exception):
+        implementation.Digit(measure)
+    with pytest.raises(Exception):
+        implementation.Digit(measure, 1, 2, 3, 4, 5)
+    with pytest.raises(Exception):
+        implementation.Digit(measure, 1, 2, 3) + implementation.Digit(measure, 4, 5)
+    with pytest.raises(Exception):
+        implementation.Node(measure, 1)
+    with pytest.raises(Exception):
+        implementation.Node(measure, 1, 2, 3, 4)
+
+
+def test_partition_digit(implementation):
+    measure = implementation.MEASURE_ITEM_COUNT
+    digit = implementation.Digit(measure, "a", "b", "c", "d")
+    for split in range(5):
+        left, right = digit.partition_digit(0, lambda a: a > split)
+        assert (list(left), list(right)) == (list("abcd")[:split], list("abcd")[split:])
+    for split in range(5):
+        left, right = digit.rpartition_digit(0, lambda a: a > 4 - split)
+        assert (list(left), list(right)) == (list("abcd")[:split], list("abcd")[split:])
+
+
+def test_measures(implementation):
+    assert implementation.MEASURE_ITEM_COUNT.convert("x") == 1
+    assert implementation.MEASURE_ITEM_COUNT.operator(2, 3) == 5
+    assert implementation.MeasureSum().convert(7) == 7
+    assert implementation.MeasureSum().operator(2, 3) == 5
+    minmax = implementation.MeasureMinMax()
+    assert minmax.convert(4) == (4, 4)
+    assert minmax.operator((1, 5), (0, 3)) == (0, 5)
+    assert minmax.operator(minmax.identity, (1, 2)) == (1, 2)
+    assert minmax.operator((1, 2), minmax.identity) == (1, 2)
+    assert minmax.operator(minmax.identity, minmax.identity) is minmax.identity
+    for measure in (implementation.MEASURE_ITEM_COUNT, implementation.MeasureSum(), minmax):
+        assert measure.commutative
+    tree = implementation.to_tree(implementation.MeasureSum(), range(1000))
+    assert tree.annotation == sum(range(1000))
+    assert tree.without_first().without_last().annotation == sum(range(1, 999))
+
+
+def test_float_sum_annotations_match_pure_python(implementation):
+    # Float addition isn't exactly associative, so this only passes if the
+    # compiled classes combine annotations in the same order as the
+    # pure-Python ones.
+    pure = _load_pure_ttftree()
+    rng = random.Random(1)
+    tree = implementation.Empty(implementation.MeasureSum())
+    pure_tree = pure.Empty(pure.MeasureSum())
+    for i in range(2000):
+        value = rng.uniform(0, 10000)
+        if rng.randrange(2):
+            tree, pure_tree = tree.add_first(value), pure_tree.add_first(value)
+        else:
+            tree, pure_tree = tree.add_last(value), pure_tree.add_last(value)
+        if i % 100 == 0:
+            tree.check_invariants()
+            assert tree.annotation == pure_tree.annotation
+    tree.check_invariants()
+    assert tree.annotation == pure_tree.annotation
+    joined = tree.append(tree)
+    joined.check_invariants()
+    assert joined.annotation == pure_tree.append(pure_tree).annotation
+
+
+def test_measure_subclass_overrides_are_honored(implementation):
+    class MeasureDoubledCount(implementation.MeasureItemCount):
+        def convert(self, value):
+            return 2
+    tree = implementation.Empty(MeasureDoubledCount())
+    for i in range(100):
+        tree = tree.add_last(i).add_first(i)
+    assert tree.annotation == 400
+
+
+def test_deque_operations(implementation):
+    measure = implementation.MEASURE_ITEM_COUNT
+    tree = implementation.Empty(measure)
+    model = []
+    for i in range(300):
+        tree = tree.add_last(i) if i % 3 else tree.add_first(i)
+        model = model + [i] if i % 3 else [i] + model
+        assert tree.annotation == len(model)
+    tree.check_invariants()
+    assert list(implementation.value_iterator(tree)) == model
+    while model:
+        assert tree.get_first() == model[0] and tree.get_last() == model[-1]
+        tree = tree.without_first() if len(model) % 2 else tree.without_last()
+        model = model[1:] if len(model) % 2 else model[:-1]
+        assert tree.annotation == len(model)
+    assert tree.is_empty
+
+
+@pytest.mark.parametrize("name, measure_index", [(name, i) for i, (name, measure) in enumerate(stress.measures())])
+def test_stress(implementation, monkeypatch, name, measure_index):
+    monkeypatch.setattr(stress, "ttftree", implementation)
+    name, measure = stress.measures()[measure_index]
+    stress.run(name, measure, 2000, 1234, 300, 50)
+
+
+def test_set_by_index():
+    tree = ttftree.to_tree(ttftree.MEASURE_ITEM_COUNT, range(100))
+    for view, model in ((tree, list(range(100))), (tree.reversed(), list(range(99, -1, -1)))):
+        for index in (0, 1, 50, 99, -1, -2, -100):
+            expected = list(model)
+            expected[index] = "x"
+            assert values(view.set(index, "x")) == expected
+            expected[index] = model[index] * 2
+            assert values(view.update(index, lambda v: v * 2)) == expected
+        for index in (100, -101):
+            with pytest.raises(ttftree.NoMatchingItem):
+                view.set(index, "x")
+    # Only the Nodes and Digits on the path to the value are copied, whether
+    # or not the tree is being viewed backwards.
+    first, last, middle = tree.set(0, "x"), tree.set(-1, "x"), tree.set(50, "x")
+    assert first.spine is tree.spine and first.right is tree.right
+    assert last.spine is tree.spine and last.left is tree.left
+    assert middle.left is tree.left and middle.right is tree.right
+    assert middle.spine.left is tree.spine.left or middle.spine.right is tree.spine.right
+    view = tree.reversed()
+    first, last, middle = view.set(0, "x").tree, view.set(-1, "x").tree, view.set(49, "x").tree
+    assert first.spine is tree.spine and first.left is tree.left
+    assert last.spine is tree.spine and last.right is tree.right
+    assert middle.left is tree.left and middle.right is tree.right
+    assert middle.spine.left is tree.spine.left or middle.spine.right is tree.spine.right
+    with pytest.raises(ttftree.NoMatchingItem):
+        ttftree.Empty(ttftree.MEASURE_ITEM_COUNT).set(0, "x")
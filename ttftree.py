@@ -10,7 +10,21 @@ More documentation will be provided soon.
 # giving my brain just the right information it needed to finally understand
 # 2-3 finger trees 
 
-from collections import Sequence
+from collections import deque, namedtuple
+from functools import reduce
+import os
+import sys
+import threading
+
+# The optional compiled accelerator; see the end of this module for how it's
+# used. Setting TTFTREE_NO_EXTENSION in the environment forces the pure-Python
+# classes to be used even when it's been built (e.g. to test both).
+_ttftree = None
+if not os.environ.get("TTFTREE_NO_EXTENSION"):
+    try:
+        import _ttftree
+    except ImportError:
+        pass
 
 class TTFTreeError(Exception):
     pass
@@ -25,6 +39,34 @@ class TreeIsEmpty(TTFTreeError):
         return "This tree is empty"
 
 
+class NoMatchingItem(TTFTreeError, IndexError):
+    """
+    Exception raised from Tree.set and Tree.update when the tree has no value
+    at the requested index, or no value on which the requested predicate
+    becomes true.
+    """
+    def __str__(self):
+        return "No matching item in this tree"
+
+
+class MixedOrientation(TTFTreeError):
+    """
+    Exception raised when a reversed view of a tree is concatenated with a
+    tree that isn't reversed, which can't be done without copying one of
+    them. See Reversed.
+    """
+    def __str__(self):
+        return ("Reversed views can't be concatenated with trees that aren't "
+                "reversed; call materialize() on the view first")
+
+
+class InvariantViolation(TTFTreeError):
+    """
+    Exception raised from Tree.check_invariants when a tree's structure is
+    found to be invalid.
+    """
+
+
 class Identity(object):
     pass
 
@@ -42,7 +84,14 @@ class Measure(object):
     element (the identity attribute). The value of any given tree is the
     monoidal sum of the values produced by the conversion function for all
     values contained within the tree.
+    
+    Measures whose operator is commutative should set the commutative
+    attribute to True. Reversed views of trees (see Tree.reversed) can then
+    use the measure as-is instead of wrapping it in one that swaps the
+    operator's arguments.
     """
+    commutative = False
+    
     def convert(self, value):
         """
         Converts a value stored in a tree to a value in the monoid on which
@@ -68,6 +117,22 @@ class Measure(object):
         """
         raise NotImplementedError
     
+    def content_hash(self, annotation):
+        """
+        Returns a hash of the values in a tree given that tree's annotation,
+        or None if this measure's annotations don't carry enough information
+        to compute one.
+        
+        Tree.__hash__ uses this to hash trees in O(1) time when their measure
+        supports it and falls back to hashing every value in the tree when it
+        doesn't. Measures that return a hash from this function must return
+        exactly the hash that Tree.__hash__ would otherwise have computed; see
+        MeasureContentHash.
+        
+        The default implementation returns None.
+        """
+        return None
+
 
 class CustomMeasure(Measure):
     """
@@ -103,6 +168,11 @@ class MeasureItemCount(Measure):
         left, right = some_tree.partition(lambda v: v > n)
         some_tree = left.add_last(value_to_insert).append(right)
     
+    The value at the nth position in the tree can be replaced in O(log n) time
+    without changing the shape of the tree:
+    
+        some_tree = some_tree.set(n, new_value)
+    
     The value at the nth position in the tree can be removed in O(log n) time:
     
         left, right = some_tree.partition(lambda v: v > n)
@@ -126,6 +196,8 @@ class MeasureItemCount(Measure):
     You'll typically want to use that constant instead of constructing a whole
     new instance of MeasureItemCount.
     """
+    commutative = True
+    
     def __init__(self):
         Measure.__init__(self)
         self.identity = 0
@@ -137,6 +209,29 @@ class MeasureItemCount(Measure):
         return a + b
 
 
+class MeasureSum(Measure):
+    """
+    A measure that produces the sum of the values in a tree, which must be
+    numbers.
+    
+    Trees annotated with such a measure can be partitioned at the point where
+    a running total first exceeds some amount:
+    
+        left, right = some_tree.partition(lambda v: v > amount)
+    """
+    commutative = True
+    
+    def __init__(self):
+        Measure.__init__(self)
+        self.identity = 0
+    
+    def convert(self, value):
+        return value
+    
+    def operator(self, a, b):
+        return a + b
+
+
 class MeasureWithIdentity(Measure):
     """
     An abstract subclass of Measure that uses ttftree.IDENTITY as the identity
@@ -176,13 +271,63 @@ class MeasureLastItem(MeasureWithIdentity):
 
 
 class MeasureMinMax(MeasureWithIdentity):
+    """
+    A measure that produces a tuple (min, max) of the smallest and largest
+    values in a tree.
+    """
+    commutative = True
+    
     def convert(self, value):
-        return value
+        return value, value
+    
+    def semigroup_operator(self, a, b):
+        a_min, a_max = a
+        b_min, b_max = b
+        return min(a_min, b_min), max(a_max, b_max)
+
+
+# Parameters of the polynomial hash used to hash trees' contents. The modulus
+# is the Mersenne prime 2**61 - 1.
+_HASH_MODULUS = (1 << 61) - 1
+_HASH_BASE = 1000003
+
+
+class MeasureContentHash(Measure):
+    """
+    A measure that annotates a tree with a hash of its contents, allowing
+    hash(tree) to run in O(1) time instead of O(n).
+    
+    The annotation is a pair (h, p), where h is a polynomial hash of the hashes
+    of the tree's values and p is the hash's base raised to the number of
+    values in the tree, modulo a large prime. Keeping p around is what makes
+    the hash a monoid: two trees' hashes can be combined without knowing
+    anything else about them.
+    
+    Note that two trees with equal contents always have equal hashes whether
+    or not they're annotated with this measure, so trees annotated with it
+    can be freely compared and mixed in sets and dicts with trees that
+    aren't. It's most commonly used alongside another measure by way of
+    CompoundMeasure:
+    
+        measure = CompoundMeasure(MEASURE_ITEM_COUNT, MEASURE_CONTENT_HASH)
+    
+    A singleton instance of this class is stored in
+    ttftree.MEASURE_CONTENT_HASH.
+    """
+    def __init__(self):
+        Measure.__init__(self)
+        self.identity = (0, 1)
+    
+    def convert(self, value):
+        return hash(value) % _HASH_MODULUS, _HASH_BASE
     
     def operator(self, a, b):
-            a_min, a_max = a
-            b_min, b_max = b
-            return min(a_min, b_min), max(a_max, b_max)
+        a_hash, a_power = a
+        b_hash, b_power = b
+        return (a_hash * b_power + b_hash) % _HASH_MODULUS, (a_power * b_power) % _HASH_MODULUS
+    
+    def content_hash(self, annotation):
+        return annotation[0]
 
 
 class TranslateMeasure(Measure):
@@ -205,6 +350,7 @@ class TranslateMeasure(Measure):
         self._wrapped_convert = measure.convert
         self.operator = measure.operator
         self.identity = measure.identity
+        self.commutative = measure.commutative
     
     def convert(self, value):
         return self._wrapped_convert(self._function(value))
@@ -242,12 +388,20 @@ class CompoundMeasure(Measure):
         else:
             self._make_tuple = tuple
         self.identity = self._make_tuple(m.identity for m in self.measures)
+        self.commutative = all(m.commutative for m in self.measures)
     
     def convert(self, value):
         return self._make_tuple(m.convert(value) for m in self.measures)
     
     def operator(self, a_values, b_values):
         return self._make_tuple(m.operator(a, b) for (m, a, b) in zip(self.measures, a_values, b_values))
+    
+    def content_hash(self, annotation):
+        for m, a in zip(self.measures, annotation):
+            h = m.content_hash(a)
+            if h is not None:
+                return h
+        return None
 
 
 class _NodeMeasure(Measure):
@@ -260,10 +414,42 @@ class _NodeMeasure(Measure):
         return node.annotation
 
 
+class _MirroredMeasure(Measure):
+    """
+    A measure identical to the specified measure except that its operator
+    takes its arguments in the opposite order. Folding a sequence's values
+    backwards with this measure's operator gives exactly the same result as
+    folding them forwards with the wrapped measure's operator, which is what
+    lets Reversed reuse its tree's annotations without recomputing them.
+    """
+    def __init__(self, measure):
+        self.measure = measure
+        self.convert = measure.convert
+        self.identity = measure.identity
+        self._wrapped_operator = measure.operator
+    
+    def operator(self, a, b):
+        return self._wrapped_operator(b, a)
+
+
+def _mirror(measure):
+    """
+    Returns a measure that Reversed can use to view a tree annotated with the
+    specified measure backwards.
+    """
+    if measure.commutative:
+        return measure
+    elif isinstance(measure, _MirroredMeasure):
+        return measure.measure
+    else:
+        return _MirroredMeasure(measure)
+
+
 MEASURE_ITEM_COUNT = MeasureItemCount()
+MEASURE_CONTENT_HASH = MeasureContentHash()
 
 
-class Node(Sequence):
+class Node(object):
     __slots__ = ["_values", "measure", "annotation"]
     def __init__(self, measure, *values):
         if len(values) not in (2, 3):
@@ -281,6 +467,12 @@ class Node(Sequence):
     def __len__(self):
         return len(self._values)
     
+    def __iter__(self):
+        return iter(self._values)
+    
+    def __reversed__(self):
+        return reversed(self._values)
+    
     def __add__(self, other):
         return Node(self.measure, *self._values + other._values)
     
@@ -288,7 +480,7 @@ class Node(Sequence):
         return "<Node: %s>" % ", ".join([repr(v) for v in self])
 
 
-class Digit(Sequence):
+class Digit(object):
     __slots__ = ["_values", "measure", "annotation"]
     def __init__(self, measure, *values):
         if len(values) not in (1, 2, 3, 4):
@@ -315,6 +507,26 @@ class Digit(Sequence):
                 initial_annotation = current_annotation
         return self._values[:split_point], self._values[split_point:]
     
+    def rpartition_digit(self, initial_annotation, predicate):
+        """
+        rpartition_digit(function) => ((...), (...))
+        
+        The mirror image of partition_digit: values are combined with
+        initial_annotation starting from the right, as
+        self.measure.operator(value, initial_annotation), and the value on
+        which the predicate becomes true ends up at the end of the first
+        tuple.
+        """
+        split_point = len(self)
+        while split_point > 0:
+            current_annotation = self.measure.operator(self.measure.convert(self[split_point - 1]), initial_annotation)
+            if predicate(current_annotation):
+                break
+            else:
+                split_point -= 1
+                initial_annotation = current_annotation
+        return self._values[:split_point], self._values[split_point:]
+    
     def __getitem__(self, index):
         if isinstance(index, slice):
             return Digit(self.measure, *self._values[index])
@@ -324,6 +536,12 @@ class Digit(Sequence):
     def __len__(self):
         return len(self._values)
     
+    def __iter__(self):
+        return iter(self._values)
+    
+    def __reversed__(self):
+        return reversed(self._values)
+    
     def __add__(self, other):
         return Digit(self.measure, *self._values + other._values)
     
@@ -331,6 +549,11 @@ class Digit(Sequence):
         return "<Digit: %s>" % ", ".join([repr(v) for v in self])
 
 
+# Node and Digit deliberately don't subclass collections.abc.Sequence: doing so
+# routes iteration through the ABC's generic __getitem__-based mixins, which
+# show up on the hot path of nearly every tree operation. They define the
+# handful of sequence methods the rest of this module needs themselves.
+# 
 # Note: We have a __slots__ on Node and Digit to reduce their memory footprint,
 # but adding __slots__ to Tree and its subclasses would be premature
 # optimization: a 2-3 finger tree containing n values will have at most
@@ -370,6 +593,184 @@ class Tree(object):
         """
         return self.partition_with(predicate, self.measure.identity)
     
+    def rpartition(self, predicate):
+        """
+        Convenience function that simply returns
+        self.rpartition_with(predicate, self.measure.identity).
+        """
+        return self.rpartition_with(predicate, self.measure.identity)
+    
+    def reversed(self):
+        """
+        Returns a view of this tree with its values in reverse order.
+        
+        The view is an instance of Reversed, which supports everything every
+        other Tree does except being concatenated with a tree that isn't
+        reversed; see Reversed and materialize.
+        
+        The view's measure is the mirror image of this tree's measure: the
+        same measure with its operator's arguments swapped (unless the
+        measure is commutative, in which case it's used as-is). The view's
+        annotation is therefore the same as this tree's, and the annotations
+        passed to predicates when partitioning the view are folded with the
+        mirrored operator. For measures that aren't commutative, these differ
+        from what a tree built with the values in reverse order would see: a
+        view of [1, 2, 3] annotated with MeasureLastItem presents its values
+        as [3, 2, 1] but has the annotation 3, not 1.
+        
+        Time complexity: O(1).
+        """
+        return Reversed(self)
+    
+    def materialize(self):
+        """
+        Returns a tree containing this tree's values in the order in which it
+        presents them that isn't a reversed view, copying the values into a
+        new tree if necessary.
+        
+        Trees that aren't reversed views are returned as-is. Reversed views
+        are copied into a new tree annotated with the measure of the tree
+        they're a view of; this is what's needed to concatenate a view with
+        a tree that isn't reversed.
+        
+        Time complexity: O(1), or O(n) for reversed views.
+        """
+        return self
+    
+    def rotate(self, k):
+        """
+        Returns a tree containing this tree's values rotated left by k places:
+        the first k values are moved, in order, to the end. Negative values of
+        k rotate right instead, and k may be larger than the tree.
+        
+        This tree's annotations must be item counts (i.e. it must use
+        MEASURE_ITEM_COUNT or a measure that behaves identically); use
+        rotate_with to rotate trees annotated with other measures.
+        
+        Time complexity: O(log n).
+        """
+        if self.is_empty:
+            return self
+        k %= self.annotation
+        return self.rotate_with(lambda v: v > k)
+    
+    def rotate_with(self, predicate):
+        """
+        Moves the values before the point at which the specified predicate
+        becomes true (in the sense of partition) to the end of this tree.
+        
+        Time complexity: O(log n).
+        """
+        left, right = self.partition(predicate)
+        return right.append(left)
+    
+    def set(self, index_or_predicate, value):
+        """
+        Returns a new tree with one of this tree's values replaced by the
+        specified value. See update for what index_or_predicate means.
+        
+        Time complexity: O(log n).
+        """
+        return self.update(index_or_predicate, lambda old_value: value)
+    
+    def update(self, index_or_predicate, function):
+        """
+        Returns a new tree with one of this tree's values, v, replaced by
+        function(v).
+        
+        If index_or_predicate is an int, it's the index of the value to
+        replace; negative indexes count from the end of the tree, as they do
+        for lists. Indexes can only be used with trees whose annotations are
+        item counts (see MeasureItemCount). Otherwise index_or_predicate is a
+        predicate, and the value replaced is the one on which the predicate
+        becomes true, i.e. the first value of the right tree that
+        self.partition(index_or_predicate) would return. NoMatchingItem is
+        raised if there's no such value.
+        
+        Unlike replacing a value by partitioning the tree and joining it back
+        together, this leaves the tree's shape untouched: only the Nodes and
+        Digits on the path from the root to the value are copied (and their
+        annotations recomputed), and everything else is shared with this
+        tree.
+        
+        Time complexity: O(log n).
+        """
+        if isinstance(index_or_predicate, int):
+            index = index_or_predicate
+            if index < 0:
+                index += self.annotation
+            if not 0 <= index < self.annotation:
+                raise NoMatchingItem
+            predicate = lambda v: v > index
+        else:
+            predicate = index_or_predicate
+        return self.update_with(predicate, self.measure.identity, lambda value, initial_annotation: function(value))
+    
+    def check_invariants(self):
+        """
+        Checks that this tree is structurally valid, raising
+        InvariantViolation if it isn't.
+        
+        Every Node must have 2 or 3 children and every Digit 1 to 4, nested
+        trees must contain Nodes of the right depth, and every cached
+        annotation must equal the annotation recomputed from its children
+        with this tree's measure. This is a debugging aid for testing changes
+        to the tree algorithms; valid trees never fail it.
+        
+        Time complexity: O(n).
+        """
+        _check_invariants(self)
+    
+    def stats(self, other=None):
+        """
+        Returns a TreeStats instance describing the shape and memory usage of
+        this tree.
+        
+        If other is specified, it should be another version of this tree
+        (i.e. one derived from it, or from which it was derived). The bytes
+        used by structural objects that this tree shares with other will be
+        reported separately from those used by objects only this tree holds
+        on to, which is how much memory would be freed if this tree were
+        dropped while other was kept.
+        
+        Only the tree's own structure (its Tree, Digit and Node instances) is
+        measured; the values stored in the tree are not.
+        
+        Time complexity: O(n), proportional to the number of structural
+        objects in this tree (and in other, if specified). No annotations are
+        recomputed.
+        """
+        if other is None:
+            shared_ids = set()
+        else:
+            shared_ids = set(id(item) for kind, level, item in _walk_structure(other))
+        levels = []
+        measure_ids = set()
+        total_bytes = 0
+        shared_bytes = 0
+        for kind, level, item in _walk_structure(self):
+            measure_ids.add(id(item.measure))
+            size = _structure_size(kind, item)
+            total_bytes += size
+            if id(item) in shared_ids:
+                shared_bytes += size
+            while len(levels) <= level:
+                levels.append([0, 0, 0, 0])
+            if kind == "digit":
+                levels[level][0] += 1
+                levels[level][1] += len(item)
+            elif kind == "node":
+                levels[level][2] += 1
+                levels[level][3] += len(item)
+        return TreeStats(
+            depth=len(levels),
+            levels=[LevelStats(level, digits, _fill(digit_children, digits * 4), nodes, _fill(node_children, nodes * 3))
+                    for level, (digits, digit_children, nodes, node_children) in enumerate(levels)],
+            total_bytes=total_bytes,
+            exclusive_bytes=total_bytes - shared_bytes,
+            shared_bytes=shared_bytes,
+            measure_count=len(measure_ids))
+    
     def __add__(self, other):
         """
         A wrapper that simply returns self.append(other) unless other is not an
@@ -387,6 +788,265 @@ class Tree(object):
         if not isinstance(other, Tree):
             return NotImplemented
         return self.prepend(other)
+    
+    # Trees compare like Python lists do: element by element, with the first
+    # pair of unequal values deciding the result and a tree that's a prefix of
+    # another comparing less than it. See _first_difference for how shared
+    # structure is skipped.
+    
+    def __eq__(self, other):
+        if not isinstance(other, Tree):
+            return NotImplemented
+        if self is other:
+            return True
+        # If both trees can hash themselves in O(1) time, a mismatched hash
+        # saves us from having to walk them at all.
+        self_hash = self.measure.content_hash(self.annotation)
+        other_hash = other.measure.content_hash(other.annotation)
+        if self_hash is not None and other_hash is not None and self_hash != other_hash:
+            return False
+        return _first_difference(self, other) is None
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __lt__(self, other):
+        if not isinstance(other, Tree):
+            return NotImplemented
+        return _compare(self, other, lambda a, b: a < b, False)
+    
+    def __le__(self, other):
+        if not isinstance(other, Tree):
+            return NotImplemented
+        return _compare(self, other, lambda a, b: a <= b, True)
+    
+    def __gt__(self, other):
+        if not isinstance(other, Tree):
+            return NotImplemented
+        return _compare(self, other, lambda a, b: a > b, False)
+    
+    def __ge__(self, other):
+        if not isinstance(other, Tree):
+            return NotImplemented
+        return _compare(self, other, lambda a, b: a >= b, True)
+    
+    def __hash__(self):
+        """
+        Returns a hash of this tree's values.
+        
+        Time complexity: O(1) if this tree's measure can compute a hash from
+        the tree's annotation (see MeasureContentHash), O(n) otherwise.
+        """
+        h = self.measure.content_hash(self.annotation)
+        if h is None:
+            measure = MEASURE_CONTENT_HASH
+            h = reduce(measure.operator, map(measure.convert, value_iterator(self)), measure.identity)[0]
+        return h
+
+
+TreeStats = namedtuple("TreeStats", ["depth", "levels", "total_bytes", "exclusive_bytes", "shared_bytes", "measure_count"])
+TreeStats.__doc__ = """
+Statistics about a tree, as returned from Tree.stats().
+
+depth is the number of levels of nested trees, counting the tree itself as
+the first. levels is a list of depth LevelStats instances, one for each
+level. total_bytes is the number of bytes used by all of the tree's
+structural objects; it's split into exclusive_bytes and shared_bytes
+according to whether each object is also part of the other version of the
+tree passed to stats(). measure_count is the number of distinct measure
+objects referenced by the tree's structural objects.
+"""
+
+
+LevelStats = namedtuple("LevelStats", ["level", "digit_count", "digit_fill", "node_count", "node_fill"])
+LevelStats.__doc__ = """
+Statistics about one level of a tree, as found in TreeStats.levels.
+
+Level 0 is the tree itself and level n is the tree nested n levels deep.
+digit_count is the number of Digits belonging to the tree at this level and
+node_count is the number of Nodes whose values are n levels deep, i.e. those
+stored (directly or inside other Nodes) in the tree at level n. digit_fill
+and node_fill are the average number of children of those Digits and Nodes
+divided by the most they can hold (4 and 3, respectively), or 0.0 if there
+aren't any.
+"""
+
+
+def _walk_structure(tree):
+    """
+    Yields a tuple (kind, level, item) for every structural object making up
+    the specified tree, where kind is one of "tree", "digit" or "node". For
+    trees and digits, level is how deeply nested the tree is; for nodes, it's
+    the number of levels of nodes beneath the node, including itself.
+    
+    Each object is yielded (and its children visited) only once, however
+    many times it's referenced, so the walk takes time proportional to the
+    number of distinct structural objects even in trees that share subtrees
+    with themselves (such as those built by repeatedly appending a tree to
+    itself).
+    """
+    seen_ids = set()
+    stack = [("tree", 0, tree)]
+    while stack:
+        entry = stack.pop()
+        kind, level, item = entry
+        if id(item) in seen_ids:
+            continue
+        seen_ids.add(id(item))
+        yield entry
+        if kind == "tree":
+            if isinstance(item, Reversed):
+                stack.append(("tree", level, item.tree))
+            elif isinstance(item, Single):
+                if level > 0:
+                    stack.append(("node", level, item.item))
+            elif isinstance(item, Deep):
+                stack.append(("digit", level, item.right))
+                stack.append(("tree", level + 1, item.spine))
+                stack.append(("digit", level, item.left))
+        elif kind == "digit":
+            if level > 0:
+                for child in item:
+                    stack.append(("node", level, child))
+        elif level > 1:
+            for child in item:
+                stack.append(("node", level - 1, child))
+
+
+def _check_invariants(tree):
+    """
+    Implementation of Tree.check_invariants.
+    """
+    if isinstance(tree, Reversed):
+        if tree.annotation != tree.tree.annotation:
+            raise InvariantViolation("Reversed annotation %r doesn't match its tree's annotation %r" % (tree.annotation, tree.tree.annotation))
+        tree = tree.tree
+    measure = tree.measure
+    
+    # Annotation of an item found in the tree at the given level: values at
+    # level 0 are converted with the measure, and Nodes (which are what all
+    # deeper levels contain) carry their own.
+    def annotation_of(item, level):
+        if level == 0:
+            return measure.convert(item)
+        elif not isinstance(item, Node):
+            raise InvariantViolation("Expected a Node at level %d, found %r" % (level, item))
+        else:
+            return item.annotation
+    
+    def check_fold(description, item, level):
+        # Check the annotation of a Node or Digit whose children are found at
+        # the given level.
+        expected = reduce(measure.operator, [annotation_of(child, level) for child in item])
+        if item.annotation != expected:
+            raise InvariantViolation("%s has annotation %r, expected %r" % (description, item.annotation, expected))
+    
+    def check_nodes(items, level):
+        # Check the given Nodes, which must be level levels deep, and all of
+        # the Nodes nested inside them.
+        stack = [(item, level) for item in items]
+        while stack:
+            node, depth = stack.pop()
+            if not isinstance(node, Node):
+                raise InvariantViolation("Expected a Node at level %d, found %r" % (depth, node))
+            if len(node) not in (2, 3):
+                raise InvariantViolation("Node at level %d has %d children" % (depth, len(node)))
+            check_fold("Node at level %d" % depth, node, depth - 1)
+            if depth > 1:
+                stack.extend((child, depth - 1) for child in node)
+    
+    level = 0
+    while True:
+        if isinstance(tree, Empty):
+            if tree.annotation != measure.identity:
+                raise InvariantViolation("Empty tree at level %d has annotation %r" % (level, tree.annotation))
+            return
+        elif isinstance(tree, Single):
+            if level > 0:
+                check_nodes([tree.item], level)
+            if tree.annotation != annotation_of(tree.item, level):
+                raise InvariantViolation("Single at level %d has annotation %r, expected %r" % (level, tree.annotation, annotation_of(tree.item, level)))
+            return
+        elif isinstance(tree, Deep):
+            for digit in (tree.left, tree.right):
+                if not isinstance(digit, Digit):
+                    raise InvariantViolation("Expected a Digit at level %d, found %r" % (level, digit))
+                if len(digit) not in (1, 2, 3, 4):
+                    raise InvariantViolation("Digit at level %d has %d children" % (level, len(digit)))
+                # Check the Digit's Nodes first so that a bad Node is reported
+                # as such instead of as a bad Digit.
+                if level > 0:
+                    check_nodes(digit, level)
+                check_fold("Digit at level %d" % level, digit, level)
+            expected = measure.operator(measure.operator(tree.left.annotation, tree.spine.annotation), tree.right.annotation)
+            if tree.annotation != expected:
+                raise InvariantViolation("Deep at level %d has annotation %r, expected %r" % (level, tree.annotation, expected))
+            # The spine's own annotation is checked against its contents on
+            # the next iteration.
+            tree = tree.spine
+            level += 1
+        else:
+            raise InvariantViolation("Expected a tree at level %d, found %r" % (level, tree))
+
+
+def _structure_size(kind, item):
+    """
+    Returns the number of bytes used by the specified structural object, not
+    counting its children.
+    """
+    size = sys.getsizeof(item)
+    instance_dict = getattr(item, "__dict__", None)
+    if instance_dict is not None:
+        size += sys.getsizeof(instance_dict)
+    if kind != "tree":
+        size += sys.getsizeof(item._values)
+    return size
+
+
+def _fill(children, capacity):
+    if not capacity:
+        return 0.0
+    return float(children) / capacity
+
+
+def _update_child(container, predicate, initial_annotation, function):
+    """
+    Returns a copy of the specified Node or Digit with the child on which the
+    predicate becomes true replaced by function(child, annotation), where
+    annotation is initial_annotation combined with the annotations of the
+    children before it.
+    """
+    measure = container.measure
+    values = list(container)
+    for i, child in enumerate(values):
+        current_annotation = measure.operator(initial_annotation, measure.convert(child))
+        if predicate(current_annotation):
+            values[i] = function(child, initial_annotation)
+            return type(container)(measure, *values)
+        initial_annotation = current_annotation
+    raise NoMatchingItem
+
+
+def _rupdate_child(container, predicate, initial_annotation, function):
+    """
+    The mirror image of _update_child: children are combined with
+    initial_annotation starting from the right, as
+    measure.operator(child, initial_annotation), and the replaced child is
+    passed the annotation of the children after it.
+    """
+    measure = container.measure
+    values = list(container)
+    for i in range(len(values) - 1, -1, -1):
+        child = values[i]
+        current_annotation = measure.operator(measure.convert(child), initial_annotation)
+        if predicate(current_annotation):
+            values[i] = function(child, initial_annotation)
+            return type(container)(measure, *values)
+        initial_annotation = current_annotation
+    raise NoMatchingItem
 
 
 def to_tree(measure, sequence):
@@ -445,6 +1105,15 @@ class Empty(Tree):
     def partition_with(self, predicate, initial_annotation):
         return self, self
     
+    def rpartition_with(self, predicate, initial_annotation):
+        return self, self
+    
+    def update_with(self, predicate, initial_annotation, function):
+        raise NoMatchingItem
+    
+    def rupdate_with(self, predicate, initial_annotation, function):
+        raise NoMatchingItem
+    
     def __repr__(self):
         return "<Empty>"
 
@@ -495,6 +1164,24 @@ class Single(Tree):
         else:
             return self, Empty(self.measure)
     
+    def rpartition_with(self, predicate, initial_annotation):
+        if predicate(self.measure.operator(self.annotation, initial_annotation)):
+            return self, Empty(self.measure)
+        else:
+            return Empty(self.measure), self
+    
+    def update_with(self, predicate, initial_annotation, function):
+        if predicate(self.measure.operator(initial_annotation, self.annotation)):
+            return Single(self.measure, function(self.item, initial_annotation))
+        else:
+            raise NoMatchingItem
+    
+    def rupdate_with(self, predicate, initial_annotation, function):
+        if predicate(self.measure.operator(self.annotation, initial_annotation)):
+            return Single(self.measure, function(self.item, initial_annotation))
+        else:
+            raise NoMatchingItem
+    
     def __repr__(self):
         return "<Single: %r>" % (self.item,)
 
@@ -783,10 +1470,188 @@ class Deep(Tree):
             left_items, right_items = self.right.partition_digit(spine_annotation, predicate)
             return deep_right(self.measure, self.left, self.spine, left_items), to_tree(self.measure, right_items)
     
+    def rpartition_with(self, predicate, initial_annotation):
+        """
+        The mirror image of partition_with: annotations are accumulated from
+        the right end of this tree instead of the left, with
+        initial_annotation as the rightmost operand, and the value on which
+        the predicate becomes true ends up at the end of the left tree.
+        
+        Time complexity: O(log min(m, n)), where m and n are the sizes of the
+        resulting trees.
+        """
+        right_annotation = self.measure.operator(self.right.annotation, initial_annotation)
+        spine_annotation = self.measure.operator(self.spine.annotation, right_annotation)
+        if predicate(right_annotation):
+            left_items, right_items = self.right.rpartition_digit(initial_annotation, predicate)
+            return deep_right(self.measure, self.left, self.spine, left_items), to_tree(self.measure, right_items)
+        elif predicate(spine_annotation):
+            left_spine, right_spine = self.spine.rpartition_with(predicate, right_annotation)
+            # The node in which the predicate became true is the last one in
+            # the left half this time.
+            split_node = left_spine.get_last()
+            left_spine = left_spine.without_last()
+            before_digit, after_digit = Digit(self.measure, *split_node).rpartition_digit(self.measure.operator(right_spine.annotation, right_annotation), predicate)
+            return deep_right(self.measure, self.left, left_spine, before_digit), deep_left(self.measure, after_digit, right_spine, self.right)
+        else:
+            left_items, right_items = self.left.rpartition_digit(spine_annotation, predicate)
+            return to_tree(self.measure, left_items), deep_left(self.measure, right_items, self.spine, self.right)
+    
+    def update_with(self, predicate, initial_annotation, function):
+        """
+        Returns a new tree with the value on which the specified predicate
+        becomes true (in the sense of partition_with) replaced by
+        function(value, annotation), where annotation is initial_annotation
+        combined with the annotations of all of the values before it.
+        NoMatchingItem is raised if the predicate never becomes true.
+        
+        This is what Tree.update is built on. The new tree has exactly the
+        same shape as this one: it shares everything with this tree except
+        for the Nodes and Digits containing the value, at most one per level.
+        
+        Time complexity: O(log n).
+        """
+        left_annotation = self.measure.operator(initial_annotation, self.left.annotation)
+        spine_annotation = self.measure.operator(left_annotation, self.spine.annotation)
+        if predicate(left_annotation):
+            return Deep(self.measure, _update_child(self.left, predicate, initial_annotation, function), self.spine, self.right)
+        elif predicate(spine_annotation):
+            # The spine's values are Nodes, so update the one containing our
+            # value by descending into it in turn.
+            update_node = lambda node, node_annotation: _update_child(node, predicate, node_annotation, function)
+            return Deep(self.measure, self.left, self.spine.update_with(predicate, left_annotation, update_node), self.right)
+        else:
+            return Deep(self.measure, self.left, self.spine, _update_child(self.right, predicate, spine_annotation, function))
+    
+    def rupdate_with(self, predicate, initial_annotation, function):
+        """
+        The mirror image of update_with: annotations are accumulated from the
+        right end of this tree instead of the left, with initial_annotation as
+        the rightmost operand, and function is passed initial_annotation
+        combined with the annotations of all of the values after the one
+        being replaced. This is what lets Reversed update values in place.
+        
+        Time complexity: O(log n).
+        """
+        right_annotation = self.measure.operator(self.right.annotation, initial_annotation)
+        spine_annotation = self.measure.operator(self.spine.annotation, right_annotation)
+        if predicate(right_annotation):
+            return Deep(self.measure, self.left, self.spine, _rupdate_child(self.right, predicate, initial_annotation, function))
+        elif predicate(spine_annotation):
+            update_node = lambda node, node_annotation: _rupdate_child(node, predicate, node_annotation, function)
+            return Deep(self.measure, self.left, self.spine.rupdate_with(predicate, right_annotation, update_node), self.right)
+        else:
+            return Deep(self.measure, _rupdate_child(self.left, predicate, spine_annotation, function), self.spine, self.right)
+    
     def __repr__(self):
         return "<Deep: left=%r, spine=%r, right=%r>" % (self.left, self.spine, self.right)
 
 
+class Reversed(Tree):
+    """
+    A subclass of Tree representing another tree with its values in reverse
+    order. Instances are obtained from Tree.reversed().
+    
+    Reversed doesn't copy anything: it simply swaps the meanings of first and
+    last (and of left and right when partitioning) before passing each
+    operation on to the tree it wraps, and re-wraps whatever that tree
+    returns. Every operation therefore has the same time complexity on a
+    Reversed as it does on the tree being viewed. Concatenating two Reversed
+    instances is as fast as concatenating any other two trees.
+    
+    The one thing a Reversed can't do cheaply is be concatenated with a tree
+    of two or more values that isn't itself reversed: the two trees' Nodes are
+    laid out in opposite directions, so one of them would have to be copied.
+    Rather than silently taking O(n) time, such concatenations raise
+    MixedOrientation; call materialize() on the Reversed first to copy it
+    into an ordinary tree explicitly.
+    """
+    def __init__(self, tree, measure=None):
+        """
+        Creates a view of the specified tree with its values in reverse order.
+        measure, if specified, must be _mirror(tree.measure); it's accepted
+        only so that a Reversed's operations don't have to create a new
+        mirrored measure every time they're called.
+        """
+        if measure is None:
+            measure = _mirror(tree.measure)
+        self.measure = measure
+        self.annotation = tree.annotation
+        self.is_empty = tree.is_empty
+        self.tree = tree
+    
+    def _wrap(self, tree):
+        return Reversed(tree, self.measure)
+    
+    def reversed(self):
+        """
+        Returns the tree this Reversed is a view of.
+        
+        Time complexity: O(1).
+        """
+        return self.tree
+    
+    def get_first(self):
+        return self.tree.get_last()
+    
+    def without_first(self):
+        return self._wrap(self.tree.without_last())
+    
+    def add_first(self, item):
+        return self._wrap(self.tree.add_last(item))
+    
+    def get_last(self):
+        return self.tree.get_first()
+    
+    def without_last(self):
+        return self._wrap(self.tree.without_first())
+    
+    def add_last(self, item):
+        return self._wrap(self.tree.add_first(item))
+    
+    def prepend(self, other):
+        if isinstance(other, Reversed):
+            return self._wrap(self.tree.append(other.tree))
+        elif not isinstance(other, Deep):
+            return other.append(self)
+        elif not isinstance(self.tree, Deep):
+            # A view of at most one value is no different from the tree it's
+            # a view of.
+            return other.append(self.tree)
+        else:
+            raise MixedOrientation
+    
+    def append(self, other):
+        if isinstance(other, Reversed):
+            return self._wrap(other.tree.append(self.tree))
+        elif not isinstance(other, Deep):
+            return other.prepend(self)
+        elif not isinstance(self.tree, Deep):
+            return self.tree.append(other)
+        else:
+            raise MixedOrientation
+    
+    def materialize(self):
+        return to_tree(self.tree.measure, value_iterator(self))
+    
+    def partition_with(self, predicate, initial_annotation):
+        left, right = self.tree.rpartition_with(predicate, initial_annotation)
+        return self._wrap(right), self._wrap(left)
+    
+    def rpartition_with(self, predicate, initial_annotation):
+        left, right = self.tree.partition_with(predicate, initial_annotation)
+        return self._wrap(right), self._wrap(left)
+    
+    def update_with(self, predicate, initial_annotation, function):
+        return self._wrap(self.tree.rupdate_with(predicate, initial_annotation, function))
+    
+    def rupdate_with(self, predicate, initial_annotation, function):
+        return self._wrap(self.tree.update_with(predicate, initial_annotation, function))
+    
+    def __repr__(self):
+        return "<Reversed: %r>" % (self.tree,)
+
+
 def value_iterator(tree):
     """
     A generator function that yields each value from the given tree in
@@ -802,25 +1667,294 @@ def value_iterator(tree):
     while not tree.is_empty:
         yield tree.get_first()
         tree = tree.without_first()
-    
-
-
-
-
-
-
-
-
-
-
-
 
 
+# Marker returned from _first_difference in place of a value when one of the
+# trees it's comparing runs out of values before the other.
+_END = object()
 
 
+def _first_difference(tree, other):
+    """
+    Walks the two specified trees side by side and returns a tuple (a, b) of
+    the first pair of values at the same position that aren't equal, or None
+    if both trees contain equal values. If one tree runs out of values before
+    the other, its half of the tuple will be _END.
+    
+    Versions of a tree derived from one another share most of their Nodes,
+    Digits and spines, and a structural object found at the same position in
+    both trees contains the same values in both, so the walk skips it without
+    looking inside. Comparing two versions of a large tree that differ in a
+    handful of places therefore takes time roughly proportional to the number
+    of differences times log n instead of n.
+    """
+    # Each stack holds the parts of its tree that have yet to be visited, with
+    # the leftmost on top. Entries are tuples (depth, item, is_tree,
+    # backwards): a tree entry is a Tree whose values are of the given depth,
+    # and any other entry is a Node or Digit of the given depth or, at depth
+    # 0, a value. backwards is true for parts of a tree seen through a
+    # Reversed, whose children have to be visited right to left. Both stacks
+    # always start at the same position in their respective trees.
+    a_stack = [(0, tree, True, False)]
+    b_stack = [(0, other, True, False)]
+    while a_stack and b_stack:
+        a_depth, a, a_is_tree, a_backwards = a_stack[-1]
+        b_depth, b, b_is_tree, b_backwards = b_stack[-1]
+        if a is b and a_depth == b_depth and a_is_tree == b_is_tree and (a_backwards == b_backwards or (a_depth == 0 and not a_is_tree)):
+            a_stack.pop()
+            b_stack.pop()
+        # Otherwise break apart whichever entry is bigger until we either find
+        # something the two trees share or get down to two values.
+        elif a_is_tree:
+            _expand_entry(a_stack)
+        elif b_is_tree:
+            _expand_entry(b_stack)
+        elif a_depth > 0 and a_depth >= b_depth:
+            _expand_entry(a_stack)
+        elif b_depth > 0:
+            _expand_entry(b_stack)
+        else:
+            a_stack.pop()
+            b_stack.pop()
+            if not a == b:
+                return a, b
+    # At least one of the trees has run out of values. If the other hasn't,
+    # that's the difference.
+    a = _next_value(a_stack)
+    b = _next_value(b_stack)
+    if a is _END and b is _END:
+        return None
+    return a, b
+
+
+def _expand_entry(stack):
+    """
+    Replaces the Tree, Node or Digit entry on top of the specified stack (see
+    _first_difference) with entries for its parts.
+    """
+    depth, item, is_tree, backwards = stack.pop()
+    if is_tree:
+        if isinstance(item, Reversed):
+            stack.append((depth, item.tree, True, not backwards))
+        elif isinstance(item, Single):
+            stack.append((depth, item.item, False, backwards))
+        elif isinstance(item, Deep):
+            if backwards:
+                first, last = item.right, item.left
+            else:
+                first, last = item.left, item.right
+            stack.append((depth + 1, last, False, backwards))
+            stack.append((depth + 1, item.spine, True, backwards))
+            stack.append((depth + 1, first, False, backwards))
+    else:
+        children = item if backwards else reversed(item)
+        for child in children:
+            stack.append((depth - 1, child, False, backwards))
 
 
+def _next_value(stack):
+    """
+    Returns the next value from the specified stack (see _first_difference),
+    or _END if there aren't any.
+    """
+    while stack:
+        depth, item, is_tree, backwards = stack[-1]
+        if is_tree or depth > 0:
+            _expand_entry(stack)
+        else:
+            return item
+    return _END
 
 
+def _compare(tree, other, operator, if_equal):
+    """
+    Compares two trees lexicographically. operator is the comparison to apply
+    to the first pair of values that differ, and if_equal is returned when
+    there isn't one.
+    """
+    difference = _first_difference(tree, other)
+    if difference is None:
+        return if_equal
+    a, b = difference
+    # A tree that runs out of values first is a prefix of the other, so
+    # compare their lengths instead.
+    if a is _END:
+        return operator(0, 1)
+    if b is _END:
+        return operator(1, 0)
+    return operator(a, b)
+
+
+class TreeRef(object):
+    """
+    A mutable reference to a Tree that can be shared between threads.
+    
+    Trees themselves are immutable, so any number of threads can read from
+    the same tree at the same time without any coordination. What they do
+    need is a single place from which to obtain the current version of the
+    tree and to which new versions can be published; TreeRef provides that.
+    
+    Reading the current tree with get() never takes a lock. Writers publish
+    new versions with set(), compare_and_set(), or swap(), the latter of
+    which retries a function against the latest tree until its result can be
+    published without clobbering a concurrent writer's update:
+    
+        ref = TreeRef(Empty(MEASURE_ITEM_COUNT))
+        ref.swap(lambda tree: tree.add_last(value))
+    
+    The function passed to swap() may be called more than once, so it should
+    be free of side effects.
+    
+    When batch is true, add_last() queues its value instead of publishing it
+    right away. Whichever thread manages to take the write lock drains the
+    queue, adds every pending value to the tree, and publishes the result
+    once, so many producer threads feeding a single deque contend for one
+    publish instead of one per value. Values queued this way are published
+    in the order in which they were queued, but add_last() may return before
+    its value is visible through get(); call flush() to wait until every
+    value queued so far has been published.
+    """
+    def __init__(self, tree, batch=False):
+        self._tree = tree
+        self._lock = threading.Lock()
+        self._batch = batch
+        self._pending = deque()
+    
+    def get(self):
+        """
+        Returns the current tree.
+        
+        Time complexity: O(1). This never blocks.
+        """
+        return self._tree
+    
+    def set(self, tree):
+        """
+        Unconditionally replaces the current tree with the specified tree.
+        """
+        self._lock.acquire()
+        try:
+            self._tree = tree
+        finally:
+            self._release()
+    
+    def compare_and_set(self, expected, tree):
+        """
+        Replaces the current tree with the specified tree if, and only if, the
+        current tree is expected (compared by identity, not equality).
+        Returns True if the tree was replaced and False if it wasn't.
+        """
+        self._lock.acquire()
+        try:
+            if self._tree is not expected:
+                return False
+            self._tree = tree
+            return True
+        finally:
+            self._release()
+    
+    def swap(self, function):
+        """
+        Atomically replaces the current tree with function(current_tree) and
+        returns the new tree.
+        
+        The function is called without holding any lock; if another writer
+        publishes a new tree in the meantime, the function is called again on
+        that tree.
+        """
+        while True:
+            tree = self._tree
+            new_tree = function(tree)
+            if self.compare_and_set(tree, new_tree):
+                return new_tree
+    
+    def add_last(self, item):
+        """
+        Adds the specified item to the end of the current tree.
+        
+        If this reference was created with batch=True, the item is queued and
+        published along with any other queued items by whichever thread next
+        gets hold of the write lock; see this class's docstring for details.
+        """
+        if not self._batch:
+            self.swap(lambda tree: tree.add_last(item))
+            return
+        self._pending.append(item)
+        # Try to become the thread that publishes the queue. If someone else
+        # already holds the lock, they'll pick our item up when they release
+        # it; see _release.
+        if self._lock.acquire(False):
+            try:
+                self._drain()
+            finally:
+                self._release()
+    
+    def flush(self):
+        """
+        Publishes any items queued by add_last() that haven't yet been
+        published, blocking until the write lock is available.
+        """
+        self._lock.acquire()
+        try:
+            self._drain()
+        finally:
+            self._release()
+    
+    def _release(self):
+        # Every release of self._lock must go through here. add_last() only
+        # queues its item if someone else holds the lock, relying on them to
+        # publish it, so after releasing the lock we check the queue again and
+        # publish anything that was queued while we held it. If the lock has
+        # been taken again in the meantime, its new holder will do the same
+        # when it releases it.
+        self._lock.release()
+        while self._pending and self._lock.acquire(False):
+            try:
+                self._drain()
+            finally:
+                self._lock.release()
+    
+    def _drain(self):
+        # Must be called with self._lock held.
+        tree = self._tree
+        pending = self._pending
+        while pending:
+            tree = tree.add_last(pending.popleft())
+        self._tree = tree
+    
+    def __repr__(self):
+        return "<TreeRef: %r>" % (self._tree,)
 
 
+# If the compiled accelerator is available, swap in its classes. Node and
+# Digit are replaced outright. Deep and the measures below are replaced with
+# subclasses that have the compiled class as their first base, so its methods
+# take precedence over the pure-Python ones while everything else (and
+# isinstance checks against the pure-Python classes, Tree and Measure) keeps
+# working. The pure-Python classes are what's left when it isn't available.
+if _ttftree is not None:
+    _ttftree.register(Single, IDENTITY)
+    
+    Node = _ttftree.Node
+    Digit = _ttftree.Digit
+    
+    class Deep(_ttftree.DeepCore, Deep):
+        __doc__ = Deep.__doc__
+    
+    class MeasureItemCount(_ttftree.MeasureItemCountCore, MeasureItemCount):
+        __doc__ = MeasureItemCount.__doc__
+    
+    class MeasureSum(_ttftree.MeasureSumCore, MeasureSum):
+        __doc__ = MeasureSum.__doc__
+    
+    class MeasureMinMax(_ttftree.MeasureMinMaxCore, MeasureMinMax):
+        __doc__ = MeasureMinMax.__doc__
+    
+    MEASURE_ITEM_COUNT = MeasureItemCount()
+    
+    class _NodeMeasure(_ttftree.NodeMeasureCore, _NodeMeasure):
+        # NodeMeasureCore provides convert and operator (the latter calling
+        # the wrapped measure's), so they mustn't be shadowed by instance
+        # attributes as they are in the pure-Python version.
+        def __init__(self, measure):
+            self.identity = measure.identity